@@ -7,22 +7,43 @@ import logging
 import os
 import sys
 import platform
+import queue
+import re
+import shlex
+import threading
+import time
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import Future
 
 import numpy as np
+import orjson
 import fairseq
 import torch
 
 import flask
 from flask import Flask, request, send_from_directory, Blueprint
 
+from fairseq import utils
+from fairseq.data import data_utils
+from fairseq.data.encoders.space_tokenizer import SpaceTokenizer
 from fairseq.models.transformer import TransformerModel
 
-torch.set_grad_enabled(False)
-FLOAT_POINTS = 4
+# tokens that are kept as is; everything else is a variable name and gets remapped to a_0, a_1, ...
+PUNCT = frozenset(('(', ')', '*', '+', '-', '/', '-1', '[', ']', '{', '}'))
+# a whole remapped variable token in a translation; the group is its id
+VAR_RE = re.compile(r'(?<!\S)a_(\d+)(?!\S)')
 exp = None
+model = None
+generator = None
+batcher = None
+# longest accepted source, in tokens including EOS; set by load_model()
+max_src_len = None
+# options of load_model(), set aside by attach_translate_route()
+MODEL_ARGS = ('chkpt_path', 'batch_size', 'max_tokens', 'max_src_len', 'precision', 'cpu', 'jit', 'compile',
+              'max_wait_ms')
+model_args = None
+load_lock = threading.Lock()
 app = Flask(__name__)
-app.config['JSON_AS_ASCII'] = False
 
 bp = Blueprint('nmt', __name__, template_folder='templates')
 
@@ -43,24 +64,12 @@ def render_template(*args, **kwargs):
 
 
 def jsonify(obj):
-
-    def _jsonify(ob):
-        if ob is None or isinstance(ob, (int, bool, str)):
-            return ob
-        elif isinstance(ob, float):
-            return round(ob, FLOAT_POINTS)
-        elif isinstance(ob, dict):
-            return {key: _jsonify(val) for key, val in ob.items()}
-        elif isinstance(ob, list):
-            return [_jsonify(it) for it in ob]
-        elif isinstance(ob, np.ndarray):
-            return _jsonify(ob.tolist())
-        else:
-            logging.warning(f"Type {type(ob)} maybe not be json serializable")
-            return ob
-
-    obj = _jsonify(obj)
-    return flask.jsonify(obj)
+    """
+    Serializes obj (including numpy arrays) to a JSON response in one pass in C.
+    Unlike flask.jsonify, floats are not rounded; round arrays with np.round before passing them here.
+    """
+    return app.response_class(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS),
+                              mimetype='application/json')
 
 @bp.route('/')
 def index():
@@ -72,9 +81,196 @@ def favicon():
     return send_from_directory(os.path.join(bp.root_path, 'static', 'favicon'), 'favicon.ico')
 
 
-def attach_translate_route(cli_args):
-    global model
-    model = TransformerModel.from_pretrained(cli_args.pop("chkpt_path"), checkpoint_file='checkpoint_best.pt', data_name_or_path='data-bin/')
+def collate(tokens, lengths):
+    """Pads a batch of source token tensors into a (pinned, when on GPU) host tensor"""
+    pin_memory = model.device.type == 'cuda'
+    max_len = int(lengths.max())
+    src_tokens = torch.full((len(tokens), max_len), model.src_dict.pad(), dtype=torch.long,
+                            pin_memory=pin_memory)
+    # scatter all tokens in one call: row of each token, and its column (rows end at max_len when left padded)
+    rows = np.repeat(np.arange(len(tokens)), lengths)
+    starts = max_len - lengths if model.task.cfg.left_pad_source else np.zeros_like(lengths)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+    src_tokens[torch.from_numpy(rows), torch.from_numpy(cols)] = torch.cat(tokens)
+    src_lengths = torch.tensor(lengths, dtype=torch.long, pin_memory=pin_memory)
+    return src_tokens, src_lengths
+
+
+def generate(tokens):
+    """
+    Translates a list of source token tensors with the preloaded (and maybe scripted) generator.
+    Returns the token tensor of the best hypothesis of each, on CPU.
+    """
+    lengths = np.array([t.numel() for t in tokens])
+    # collate batches directly rather than building a dataset and epoch iterator per request;
+    # the generator encodes each batch once and decodes incrementally from the cached encoder states.
+    # sentences of similar length go together, so that few pad tokens are decoded and a single long
+    # sentence does not keep a whole batch of short ones decoding
+    order = np.argsort(lengths, kind='stable')
+    batches = data_utils.batch_by_size(order, lambda i: lengths[i],
+                                       max_tokens=model.cfg.dataset.max_tokens,
+                                       max_sentences=model.cfg.dataset.batch_size)
+    outputs = [None] * len(tokens)
+    for batch in batches:
+        src_tokens, src_lengths = collate([tokens[i] for i in batch], lengths[batch])
+        # copies from pinned memory are async, so they overlap with launching the encoder
+        sample = {'net_input': {'src_tokens': src_tokens.to(model.device, non_blocking=True),
+                                'src_lengths': src_lengths.to(model.device, non_blocking=True)}}
+        with torch.inference_mode():
+            hypos = generator(sample)
+        # one device -> host copy (and sync) per batch rather than per sentence; numel() needs no sync
+        best = [hyps[0]['tokens'] for hyps in hypos]
+        best = torch.cat(best).cpu().split([t.numel() for t in best])
+        # fill in input order as we go, instead of permuting back at the end
+        for i, hypo in zip(batch, best):
+            outputs[i] = hypo
+    return outputs
+
+
+def encode(toks):
+    """
+    Maps a whitespace tokenized sentence to source dictionary ids plus EOS; same as model.encode(' '.join(toks)),
+    minus joining, re-splitting and a Dictionary.index call per token when there is no tokenizer or BPE
+    """
+    if model.bpe is not None or not (model.tokenizer is None or isinstance(model.tokenizer, SpaceTokenizer)):
+        return model.encode(' '.join(toks))
+    src_dict = model.src_dict
+    # Dictionary.indices is the symbol -> id dict that Dictionary.index() looks tokens up in
+    ids = [src_dict.indices.get(tok, src_dict.unk_index) for tok in toks]
+    ids.append(src_dict.eos_index)
+    return torch.tensor(ids, dtype=torch.long)
+
+
+class Batcher:
+    """
+    Fuses the token tensors of concurrent requests into shared generate() calls.
+    A single thread owns the model; it waits up to max_wait_ms after the first queued
+    request for others to arrive, translates them all as one list and resolves their futures.
+    """
+
+    def __init__(self, translate_fn, max_wait_ms=5.0):
+        self.translate_fn = translate_fn
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, inputs) -> Future:
+        future = Future()
+        self.queue.put((inputs, future))
+        return future
+
+    def _drain(self):
+        items = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return items
+            try:
+                items.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                return items
+
+    def _run(self):
+        while True:
+            items = self._drain()
+            inputs = [inp for inps, _ in items for inp in inps]
+            try:
+                outputs = self.translate_fn(inputs)
+            except Exception as e:
+                if len(items) == 1:
+                    items[0][1].set_exception(e)
+                    continue
+                # retry the requests one by one, so that only the one(s) at fault fail
+                for inps, future in items:
+                    try:
+                        future.set_result(self.translate_fn(inps))
+                    except Exception as err:
+                        future.set_exception(err)
+                continue
+            start = 0
+            for inps, future in items:
+                future.set_result(outputs[start:start + len(inps)])
+                start += len(inps)
+
+
+def load_model():
+    """
+    Loads the model, builds the generator and starts the batcher, once per process.
+    Under gunicorn this runs in the post_fork hook (see gunicorn.conf.py), since CUDA does not survive a fork.
+    """
+    global model, generator, batcher, max_src_len
+    with load_lock:
+        if batcher is not None:
+            return
+        args = dict(model_args)
+        model = TransformerModel.from_pretrained(args.pop("chkpt_path"), checkpoint_file='checkpoint_best.pt', data_name_or_path='data-bin/')
+        # bound the translation batches; unset flags keep the checkpoint's values
+        for key in ('batch_size', 'max_tokens'):
+            val = args.pop(key, None)
+            if val:
+                model.cfg.dataset[key] = val
+
+        # decoding is memory bound, so halving the weight/activation bytes is the cheapest win on GPU
+        precision = args.pop('precision')
+        cpu = args.pop('cpu')
+        use_cuda = torch.cuda.is_available() and not cpu
+        if use_cuda:
+            model.cuda()
+            # let fp32 matmuls use TF32 tensor cores on Ampere and newer
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.backends.cudnn.benchmark = True
+            torch.set_float32_matmul_precision('high')
+        if use_cuda and precision == 'fp16':
+            model.half()
+        elif use_cuda and precision == 'bf16':
+            model.bfloat16()
+        elif not use_cuda and precision == 'int8':
+            # only the decoder's feed forward layers: attention reads its projection weights directly, and the
+            # encoder layers' fast path runs on fused copies of their weights, never calling fc1/fc2
+            ffn_layers = {name for name, _ in model.models[0].named_modules()
+                          if name.startswith('decoder.') and name.endswith(('.fc1', '.fc2'))}
+            model.models[0] = torch.quantization.quantize_dynamic(model.models[0], ffn_layers, dtype=torch.qint8)
+        elif precision != 'fp32':
+            logging.warning(f"--precision {precision} is not supported on {model.device}; running in fp32")
+        model.eval()
+        # longer sources would index past the positional embeddings of models with learned positions
+        max_positions = utils.resolve_max_positions(model.task.max_positions(),
+                                                    *[m.max_positions() for m in model.models])
+        max_positions = max_positions[0] if isinstance(max_positions, tuple) else max_positions
+        # and a source over max_tokens cannot fit in any batch; batch_by_size would fail the whole batch
+        max_src_len = min(val for val in (max_positions, args.pop('max_src_len'), model.cfg.dataset.max_tokens) if val)
+
+        # build the beam search generator once, instead of once per model.translate call
+        generator = model.task.build_generator(model.models, model.cfg.generation)
+        jit, torch_compile = args.pop('jit'), args.pop('compile')
+        if jit:
+            # from_pretrained leaves need_attn as cfg.generation.print_alignment, None by default, which does not
+            # script as a bool. The model level make_generation_fast_ only runs once and from_pretrained already
+            # used it up, so call the layers' own
+            for m in model.models:
+                for layer in m.decoder.layers:
+                    layer.make_generation_fast_(need_attn=False)
+            generator = torch.jit.script(generator)
+        elif torch_compile:
+            # compile the decoder's forward in place: swapping in the compiled module would hide that it is a
+            # FairseqIncrementalDecoder from the generator, which would then decode without the KV cache
+            for m in model.models:
+                m.decoder.forward = torch.compile(m.decoder.forward, dynamic=True)
+        if jit or torch_compile:
+            # get the profiling runs / compilation out of the way, with a few different lengths
+            for n in (1, 2, 3):
+                generate([encode(' + '.join(['( a_0 + a_1 ) * a_2'] * n).split())] * 2)
+        batcher = Batcher(generate, max_wait_ms=args.pop('max_wait_ms'))
+
+
+def attach_translate_route(cli_args, load=True):
+    global model_args
+    model_args = {key: cli_args.pop(key) for key in MODEL_ARGS}
+    if load:
+        load_model()
 
     @bp.route("/translate", methods=["POST", "GET"])
     def translate():
@@ -89,38 +285,44 @@ def attach_translate_route(cli_args):
         if not sources:
             return "Please submit 'source' parameter", 400
 
-        # Check for ASCII only
+        # Check for ASCII only; str.isascii() reads a flag CPython keeps per string, it does not scan characters
         if not all(s.isascii() for s in sources):
             return "Only ASCII characters are accepted", 400
 
         prep = request.args.get('prep', "True").lower() in ("true", "yes", "y", "t")
 
-        remap = {} # original: standardized
-        if prep:
-            # whitespace tokenize
-            tokenized = [sent.strip().split() for sent in sources]
-            var_counter = 0
-            for source in tokenized:
-                for s in source:
-                    if s not in ['(', ')', '*', '+', '-', '/', '-1', '[', ']', '{', '}'] and s not in remap.keys():
-                        std_name = "a_" + str(var_counter)
-                        var_counter += 1
-                        remap[s] = std_name
-
-            remapped = [' '. join([remap[s] if s in remap.keys() else s for s in sent]) for sent in tokenized]
-            print(remapped)
-
-        translations = []
-        unremap = {v: k for k, v in remap.items()}
-        for source in remapped:
-            translated = model.translate(source)
-            print(translated)
-            if prep:
-                # replace remapped variables with original variables
-                unremapped = ' '. join([unremap[s] if s in unremap.keys() else s for s in translated.strip().split()])
-            translations.append(unremapped)
-
+        if batcher is None:
+            # not loaded by a post_fork hook; load on first use
+            load_model()
 
+        # whitespace tokenize; split() already drops leading and trailing whitespace
+        tokenized = [sent.split() for sent in sources]
+        if prep:
+            remap = {} # original: standardized
+            orig_by_id = []  # a_i -> original, at index i
+            for toks in tokenized:
+                for tok in toks:
+                    if tok not in PUNCT and tok not in remap:
+                        remap[tok] = f"a_{len(orig_by_id)}"
+                        orig_by_id.append(tok)
+            tokenized = [[remap.get(tok, tok) for tok in toks] for toks in tokenized]
+
+        # the CPU bound string <-> token id conversions run on this request thread, so they overlap
+        # with the batcher thread decoding other requests on the GPU
+        src_tokens = [encode(toks) for toks in tokenized]
+        # reject oversized sources here, before they reach the model (and the batch shared with other requests)
+        too_long = [i for i, toks in enumerate(src_tokens) if toks.numel() > max_src_len]
+        if too_long:
+            return f"Sources {too_long} are longer than {max_src_len} tokens", 400
+
+        # sentences of concurrent requests are translated together by the batcher thread
+        translations = [model.decode(hypo) for hypo in batcher.submit(src_tokens).result()]
+        if prep:
+            # replace remapped variables with original variables; ids the model made up are kept as is
+            def unremap(m):
+                idx = int(m.group(1))
+                return orig_by_id[idx] if idx < len(orig_by_id) else m.group()
+            translations = [VAR_RE.sub(unremap, sent) for sent in translations]
 
         res = dict(source=sources, translation=translations)
         return jsonify(res)
@@ -138,7 +340,7 @@ def attach_translate_route(cli_args):
                                sys_info=sys_info) """
 
 # TODO need to update to useful fairseq args and/or sensible defaults
-def parse_args():
+def parse_args(args=None):
     parser = ArgumentParser(
         prog="fairseq-server",
         description="Deploy an RTG model to a RESTful server",
@@ -150,26 +352,51 @@ def parse_args():
     parser.add_argument("-ho", "--host", help="Host address to bind.", default='0.0.0.0')
     parser.add_argument("-b", "--base", help="Base prefix path for all the URLs")
     parser.add_argument("-msl", "--max-src-len", type=int, default=250,
-                        help="max source len; longer seqs will be truncated")
-    args = vars(parser.parse_args())
+                        help="max source len in tokens; longer seqs are rejected")
+    parser.add_argument("-bs", "--batch-size", "--max-sentences", dest="batch_size", type=int,
+                        help="max sentences per translation batch")
+    parser.add_argument("-mt", "--max-tokens", type=int,
+                        help="max source tokens (including padding) per translation batch")
+    parser.add_argument("-mw", "--max-wait-ms", type=float, default=5.0,
+                        help="how long to wait for concurrent requests to batch with")
+    compilers = parser.add_mutually_exclusive_group()
+    compilers.add_argument("--jit", action="store_true", help="Compile the beam search generator with TorchScript")
+    compilers.add_argument("--compile", action="store_true", help="Compile the decoder with torch.compile")
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU even if a GPU is available")
+    parser.add_argument("--precision", choices=['fp32', 'fp16', 'bf16', 'int8'], default='fp32',
+                        help="Inference precision; fp16 and bf16 are for GPU, int8 (dynamic quantization) for CPU")
+    args = vars(parser.parse_args(args))
     return args
 
 
-cli_args = parse_args()
-attach_translate_route(cli_args)
-app.register_blueprint(bp, url_prefix=cli_args.get('base'))
-if cli_args.pop('debug'):
-    app.debug = True
+def init_app(args=None, load=True):
+    """Registers the routes and, if load, loads the model; args default to sys.argv"""
+    cli_args = parse_args(args)
+    attach_translate_route(cli_args, load=load)
+    app.register_blueprint(bp, url_prefix=cli_args.get('base'))
+    if cli_args.pop('debug'):
+        app.debug = True
+
+    # register a home page if needed
+    if cli_args.get('base'):
+        @app.route('/')
+        def home():
+            return render_template('home.html', demo_url=cli_args.get('base'))
+    return cli_args
+
 
-# register a home page if needed
-if cli_args.get('base'):
-    @app.route('/')
-    def home():
-        return render_template('home.html', demo_url=cli_args.get('base'))
+def init_wsgi_app():
+    """
+    Initializes the app for WSGI servers, which own sys.argv; args come from $FAIRSEQ_SERVER_ARGS.
+    The model is not loaded here, so that the app can be imported before forking workers.
+    """
+    init_app(shlex.split(os.environ.get('FAIRSEQ_SERVER_ARGS', '')), load=False)
+    return app
 
 
 def main():
-    app.run(port=cli_args["port"], host=cli_args["host"])
+    cli_args = init_app()
+    app.run(port=cli_args["port"], host=cli_args["host"], threaded=True)
     # A very useful tutorial is found at:
     # https://www.digitalocean.com/community/tutorials/how-to-make-a-web-application-using-flask-in-python-3
 
@@ -0,0 +1,32 @@
+"""
+gunicorn settings for wsgi.py; gunicorn reads this file from the working directory.
+The app is imported once in the master and shared with the workers, while the model is loaded
+in each worker after the fork. Run one worker per GPU listed in CUDA_VISIBLE_DEVICES.
+"""
+import os
+
+wsgi_app = 'wsgi:app'
+bind = '0.0.0.0:6060'
+workers = 1
+threads = 8
+worker_class = 'gthread'
+preload_app = True
+# loading the model delays the first heartbeat of a worker
+timeout = 300
+
+
+def pre_fork(server, worker):
+    # runs in the master: give the new worker the first GPU no live worker holds, so that
+    # a restarted worker takes over the GPU of the one it replaces
+    gpus = os.environ.get('CUDA_VISIBLE_DEVICES', '').split(',')
+    if len(gpus) > 1:
+        taken = {getattr(w, 'gpu', None) for w in server.WORKERS.values()}
+        worker.gpu = next((gpu for gpu in gpus if gpu not in taken), gpus[0])
+
+
+def post_fork(server, worker):
+    if getattr(worker, 'gpu', None) is not None:
+        # pin the worker to its GPU, before CUDA is initialized
+        os.environ['CUDA_VISIBLE_DEVICES'] = worker.gpu
+    from app import load_model
+    load_model()
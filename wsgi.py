@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+"""
+WSGI entrypoint for serving with gunicorn; see gunicorn.conf.py for the worker settings:
+
+    FAIRSEQ_SERVER_ARGS="checkpoints/ --precision fp16" gunicorn
+"""
+from app import init_wsgi_app
+
+app = init_wsgi_app()